@@ -1,27 +1,32 @@
 from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 import os
 import logging
 import asyncio
-import json
-import random
+import orjson
+import numpy as np
 import uuid
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
-import threading
-import time
+from typing import List, Dict, Any, Optional, Set
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=50,
+    compressors="zstd,zlib",
+    retryWrites=True
+)
 db = client[os.environ['DB_NAME']]
 
 app = FastAPI()
@@ -30,24 +35,34 @@ api_router = APIRouter(prefix="/api")
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
+        await self._fan_out(lambda connection: connection.send_text(message))
+
+    async def broadcast_bytes(self, data: bytes):
+        await self._fan_out(lambda connection: connection.send_bytes(data))
+
+    async def _fan_out(self, send):
+        """Send to all connections concurrently and drop the ones that fail"""
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(send(connection) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.disconnect(connection)
 
 manager = ConnectionManager()
 
@@ -85,11 +100,8 @@ class DiagnosisRequest(BaseModel):
     query: str
     context: Optional[Dict] = None
 
-# AI Chat instance
-llm_chat = LlmChat(
-    api_key=os.environ.get('EMERGENT_LLM_KEY'),
-    session_id="network_monitor_session",
-    system_message="""You are an expert network monitoring AI assistant specializing in enterprise network diagnosis and troubleshooting. 
+# AI system prompt
+SYSTEM_MESSAGE = """You are an expert network monitoring AI assistant specializing in enterprise network diagnosis and troubleshooting. 
 
 Your capabilities include:
 1. Analyzing network performance metrics (CPU, memory, disk, latency)
@@ -106,7 +118,6 @@ When analyzing network data:
 - Explain technical concepts in accessible terms
 
 Always be concise but thorough in your analysis and recommendations."""
-).with_model("openai", "gpt-4o")
 
 # Network simulation data
 NETWORK_NODES = [
@@ -122,24 +133,49 @@ NETWORK_NODES = [
     {"name": "Firewall", "type": "security", "ip": "192.168.1.254", "location": {"x": 400, "y": 350}},
 ]
 
+# Seconds between simulation ticks
+SIMULATION_INTERVAL = 2.0
+
+# Persist node state to MongoDB every Nth simulation tick
+NODE_PERSIST_INTERVAL = 5
+
+# Alert write batching: up to ALERT_BATCH_SIZE alerts or ALERT_FLUSH_INTERVAL seconds
+ALERT_BATCH_SIZE = 500
+ALERT_FLUSH_INTERVAL = 0.5
+
 # Global variables for simulation
 network_nodes = {}
-is_simulation_running = False
+
+# Set to stop the running simulation loop; each run gets its own event
+sim_stop: Optional[asyncio.Event] = None
+
+# Alerts produced by the simulation loop, consumed by alert_writer; None stops the writer
+alert_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+alert_writer_task: Optional[asyncio.Task] = None
+
+# Struct-of-arrays view of node metrics, rows are cpu, memory, disk, latency
+node_ids: List[str] = []
+node_metrics = np.empty((4, 0))
+rng = np.random.default_rng()
 
 async def initialize_network():
     """Initialize network nodes in database"""
-    global network_nodes
+    global network_nodes, node_ids, node_metrics
+    
+    # Start from a clean slate so restarts don't leave stale nodes sharing an IP
+    network_nodes.clear()
+    initial_metrics = rng.uniform([10, 20, 15, 1], [30, 40, 35, 5], (len(NETWORK_NODES), 4)).tolist()
     
-    for node_data in NETWORK_NODES:
+    for node_data, (cpu, memory, disk, latency) in zip(NETWORK_NODES, initial_metrics):
         node = NetworkNode(
             name=node_data["name"],
             type=node_data["type"],
             ip_address=node_data["ip"],
             location=node_data["location"],
-            cpu_usage=random.uniform(10, 30),
-            memory_usage=random.uniform(20, 40),
-            disk_usage=random.uniform(15, 35),
-            network_latency=random.uniform(1, 5)
+            cpu_usage=cpu,
+            memory_usage=memory,
+            disk_usage=disk,
+            network_latency=latency
         )
         
         # Store in memory for simulation
@@ -148,52 +184,64 @@ async def initialize_network():
         # Store in database
         await db.network_nodes.replace_one(
             {"ip_address": node.ip_address},
-            node.dict(),
+            node.model_dump(),
             upsert=True
         )
+    
+    node_ids = list(network_nodes)
+    node_metrics = np.array([
+        [node.cpu_usage, node.memory_usage, node.disk_usage, node.network_latency]
+        for node in network_nodes.values()
+    ]).T.copy()
 
-def simulate_network_metrics():
+def simulate_network_metrics(now: datetime):
     """Generate realistic network metrics with occasional issues"""
     global network_nodes
     
-    for node_id, node in network_nodes.items():
-        # Base metrics with random variation
-        node.cpu_usage = max(0, min(100, node.cpu_usage + random.uniform(-5, 5)))
-        node.memory_usage = max(0, min(100, node.memory_usage + random.uniform(-3, 3)))
-        node.disk_usage = max(0, min(100, node.disk_usage + random.uniform(-1, 1)))
-        node.network_latency = max(0.1, node.network_latency + random.uniform(-1, 1))
-        
-        # Simulate occasional issues
-        if random.random() < 0.05:  # 5% chance of issues
-            issue_type = random.choice(["cpu_spike", "memory_leak", "network_congestion", "disk_full"])
-            
-            if issue_type == "cpu_spike":
-                node.cpu_usage = min(100, node.cpu_usage + random.uniform(20, 40))
-            elif issue_type == "memory_leak":
-                node.memory_usage = min(100, node.memory_usage + random.uniform(15, 30))
-            elif issue_type == "network_congestion":
-                node.network_latency = node.network_latency + random.uniform(10, 50)
-            elif issue_type == "disk_full":
-                node.disk_usage = min(100, node.disk_usage + random.uniform(10, 20))
-        
-        # Update status based on metrics
-        if node.cpu_usage > 90 or node.memory_usage > 95 or node.disk_usage > 95:
-            node.status = "critical"
-        elif node.cpu_usage > 70 or node.memory_usage > 80 or node.disk_usage > 80:
-            node.status = "warning"
-        elif random.random() < 0.02:  # 2% chance of offline
-            node.status = "offline"
-        else:
-            node.status = "online"
-        
-        node.last_seen = datetime.now(timezone.utc)
-
-async def generate_alerts():
+    n = len(node_ids)
+    cpu, memory, disk, latency = node_metrics
+    
+    # Base metrics with random variation
+    cpu += rng.uniform(-5, 5, n)
+    memory += rng.uniform(-3, 3, n)
+    disk += rng.uniform(-1, 1, n)
+    latency += rng.uniform(-1, 1, n)
+    np.clip(node_metrics[:3], 0, 100, out=node_metrics[:3])
+    np.maximum(latency, 0.1, out=latency)
+    
+    # Simulate occasional issues: 5% chance of cpu_spike, memory_leak,
+    # network_congestion or disk_full (0-3), -1 for no issue
+    issue = np.where(rng.random(n) < 0.05, rng.integers(0, 4, n), -1)
+    cpu[:] = np.where(issue == 0, np.minimum(100, cpu + rng.uniform(20, 40, n)), cpu)
+    memory[:] = np.where(issue == 1, np.minimum(100, memory + rng.uniform(15, 30, n)), memory)
+    latency[:] = np.where(issue == 2, latency + rng.uniform(10, 50, n), latency)
+    disk[:] = np.where(issue == 3, np.minimum(100, disk + rng.uniform(10, 20, n)), disk)
+    
+    # Update status based on metrics (2% chance of offline)
+    status = np.select(
+        [
+            (cpu > 90) | (memory > 95) | (disk > 95),
+            (cpu > 70) | (memory > 80) | (disk > 80),
+            rng.random(n) < 0.02,
+        ],
+        ["critical", "warning", "offline"],
+        default="online"
+    )
+    
+    # Write back to the node models served by the API
+    for node_id, metrics, node_status in zip(node_ids, node_metrics.T.tolist(), status.tolist()):
+        node = network_nodes[node_id]
+        node.cpu_usage, node.memory_usage, node.disk_usage, node.network_latency = metrics
+        node.status = node_status
+        node.last_seen = now
+
+def generate_alerts() -> List[NetworkAlert]:
     """Generate alerts based on network conditions"""
     global network_nodes
     
-    for node_id, node in network_nodes.items():
-        alerts = []
+    alerts = []
+    security_rolls = rng.random(len(network_nodes)).tolist()
+    for (node_id, node), security_roll in zip(network_nodes.items(), security_rolls):
         
         # Performance alerts
         if node.cpu_usage > 85:
@@ -234,7 +282,7 @@ async def generate_alerts():
             alerts.append(alert)
         
         # Security alerts (random simulation)
-        if random.random() < 0.01 and node.type in ["server", "firewall"]:
+        if security_roll < 0.01 and node.type in ["server", "firewall"]:
             alert = NetworkAlert(
                 node_id=node_id,
                 alert_type="security",
@@ -242,46 +290,150 @@ async def generate_alerts():
                 message=f"Suspicious activity detected on {node.name}"
             )
             alerts.append(alert)
-        
-        # Store alerts in database
-        for alert in alerts:
-            await db.network_alerts.insert_one(alert.dict())
+    
+    return alerts
 
-async def simulation_loop():
+async def wait_for_stop(stop: asyncio.Event, timeout: float):
+    """Sleep for up to timeout seconds, returning early once stop is set"""
+    try:
+        await asyncio.wait_for(stop.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+async def simulation_loop(stop: asyncio.Event):
     """Main simulation loop"""
-    global is_simulation_running
-    
-    while is_simulation_running:
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    tick = 0
+    while not stop.is_set():
         try:
+            now = datetime.now(timezone.utc)
+            persist_nodes = tick % NODE_PERSIST_INTERVAL == 0
+            tick += 1
+            
             # Update metrics
-            simulate_network_metrics()
+            simulate_network_metrics(now)
             
-            # Generate alerts
-            await generate_alerts()
+            # Generate alerts; alert_writer persists them off the tick
+            for alert in generate_alerts():
+                await alert_queue.put(alert.model_dump())
             
-            # Update database
-            for node_id, node in network_nodes.items():
-                await db.network_nodes.replace_one(
-                    {"id": node_id},
-                    node.dict(),
-                    upsert=True
-                )
+            if persist_nodes or manager.active_connections:
+                # Serialize each node once for both persistence and broadcast
+                serialized = {node_id: node.model_dump() for node_id, node in network_nodes.items()}
+            
+            # Independent I/O for this tick, awaited together
+            pending = []
+            
+            # Update database in one round-trip, at a lower cadence than broadcasts
+            if persist_nodes:
+                pending.append(db.network_nodes.bulk_write(
+                    [
+                        ReplaceOne({"id": node_id}, node_doc, upsert=True)
+                        for node_id, node_doc in serialized.items()
+                    ],
+                    ordered=False
+                ))
             
             # Broadcast updates to connected clients
-            network_data = {
-                "type": "network_update",
-                "nodes": [node.dict() for node in network_nodes.values()],
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            }
+            if manager.active_connections:
+                network_data = {
+                    "type": "network_update",
+                    "nodes": list(serialized.values()),
+                    "timestamp": now.isoformat()
+                }
+                
+                pending.append(manager.broadcast_bytes(orjson.dumps(network_data)))
             
-            await manager.broadcast(json.dumps(network_data))
+            await asyncio.gather(*pending)
             
-            # Wait before next update
-            await asyncio.sleep(2)  # Update every 2 seconds
+            # Wait for the next fixed deadline, skipping ticks missed by an overrun
+            next_tick += SIMULATION_INTERVAL
+            current = loop.time()
+            if next_tick <= current:
+                next_tick += ((current - next_tick) // SIMULATION_INTERVAL + 1) * SIMULATION_INTERVAL
+            await wait_for_stop(stop, next_tick - current)
             
         except Exception as e:
             logging.error(f"Simulation error: {e}")
-            await asyncio.sleep(5)
+            await wait_for_stop(stop, 5)
+
+async def write_alerts(batch: List[Dict[str, Any]]):
+    """Insert a batch of alerts, logging rather than raising on failure"""
+    try:
+        await db.network_alerts.insert_many(batch, ordered=False)
+    except Exception as e:
+        logging.error(f"Alert write error: {e}")
+
+async def alert_writer():
+    """Drain queued alerts into MongoDB in batches until a None sentinel arrives"""
+    loop = asyncio.get_running_loop()
+    
+    stopping = False
+    while not stopping:
+        # Block for the first alert, then gather more until the batch fills or the window closes
+        alert = await alert_queue.get()
+        if alert is None:
+            return
+        batch = [alert]
+        deadline = loop.time() + ALERT_FLUSH_INTERVAL
+        while len(batch) < ALERT_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                alert = await asyncio.wait_for(alert_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if alert is None:
+                stopping = True
+                break
+            batch.append(alert)
+        
+        await write_alerts(batch)
+
+async def flush_alerts():
+    """Write any alerts still queued"""
+    batch = []
+    while not alert_queue.empty():
+        alert = alert_queue.get_nowait()
+        if alert is not None:
+            batch.append(alert)
+    if batch:
+        await write_alerts(batch)
+
+def build_network_context(nodes: List[NetworkNode], alerts: List[Dict[str, Any]]) -> str:
+    """Render the network state section of the diagnosis prompt"""
+    parts = [
+        "",
+        "Current Network Status:",
+        f"Nodes: {len(nodes)} total",
+        f"Active Alerts: {len(alerts)}",
+        "",
+        "Recent Network Metrics:",
+    ]
+    parts.extend(  # Show top 10 nodes
+        f"- {node.name} ({node.type}): Status={node.status}, CPU={node.cpu_usage:.1f}%, Memory={node.memory_usage:.1f}%, Latency={node.network_latency:.1f}ms"
+        for node in nodes[:10]
+    )
+    
+    if alerts:
+        parts.extend(["", "Active Alerts:"])
+        parts.extend(  # Show top 5 alerts
+            f"- {alert['message']} (Severity: {alert['severity']})"
+            for alert in alerts[:5]
+        )
+    
+    parts.append("")
+    return "\n".join(parts)
+
+async def stream_json_array(cursor):
+    """Encode a Motor cursor as a JSON array one document at a time"""
+    prefix = b"["
+    async for doc in cursor:
+        yield prefix + orjson.dumps(doc)
+        prefix = b","
+    yield b"[]" if prefix == b"[" else b"]"
 
 # Routes
 @api_router.get("/")
@@ -290,13 +442,13 @@ async def root():
 
 @api_router.get("/nodes", response_model=List[NetworkNode])
 async def get_network_nodes():
-    nodes = await db.network_nodes.find().to_list(1000)
-    return [NetworkNode(**node) for node in nodes]
+    # Live state is kept in memory; Mongo holds the durable copy
+    return list(network_nodes.values())
 
 @api_router.get("/alerts", response_model=List[NetworkAlert])
 async def get_network_alerts():
-    alerts = await db.network_alerts.find({"resolved": False}).sort("timestamp", -1).to_list(100)
-    return [NetworkAlert(**alert) for alert in alerts]
+    cursor = db.network_alerts.find({"resolved": False}, {"_id": 0}).sort("timestamp", -1).limit(100)
+    return StreamingResponse(stream_json_array(cursor), media_type="application/json")
 
 @api_router.post("/alerts/{alert_id}/resolve")
 async def resolve_alert(alert_id: str):
@@ -312,33 +464,30 @@ async def resolve_alert(alert_id: str):
 async def diagnose_issue(request: DiagnosisRequest):
     try:
         # Get current network state
-        nodes = await db.network_nodes.find().to_list(1000)
-        alerts = await db.network_alerts.find({"resolved": False}).sort("timestamp", -1).to_list(20)
+        nodes = list(network_nodes.values())
+        alerts = await db.network_alerts.find(
+            {"resolved": False},
+            {"_id": 0, "message": 1, "severity": 1}
+        ).sort("timestamp", -1).to_list(20)
         
         # Prepare context for AI
-        context = f"""
-Current Network Status:
-Nodes: {len(nodes)} total
-Active Alerts: {len(alerts)}
-
-Recent Network Metrics:
-"""
-        
-        for node in nodes[:10]:  # Show top 10 nodes
-            context += f"- {node['name']} ({node['type']}): Status={node['status']}, CPU={node['cpu_usage']:.1f}%, Memory={node['memory_usage']:.1f}%, Latency={node['network_latency']:.1f}ms\n"
-        
-        if alerts:
-            context += "\nActive Alerts:\n"
-            for alert in alerts[:5]:  # Show top 5 alerts
-                context += f"- {alert['message']} (Severity: {alert['severity']})\n"
+        context = build_network_context(nodes, alerts)
         
         # Add user's context if provided
         if request.context:
-            context += f"\nAdditional Context: {json.dumps(request.context)}\n"
+            context += f"\nAdditional Context: {orjson.dumps(request.context, default=str).decode()}\n"
         
         # Query the AI
         full_query = f"{context}\n\nUser Query: {request.query}\n\nPlease provide a detailed analysis and recommendations."
         
+        # Fresh session per request: the prompt already carries the full context,
+        # so shared history would only grow the prompt over uptime
+        llm_chat = LlmChat(
+            api_key=os.environ.get('EMERGENT_LLM_KEY'),
+            session_id=str(uuid.uuid4()),
+            system_message=SYSTEM_MESSAGE
+        ).with_model("openai", "gpt-4o")
+        
         user_message = UserMessage(text=full_query)
         response = await llm_chat.send_message(user_message)
         
@@ -347,7 +496,7 @@ Recent Network Metrics:
             message=request.query,
             response=response
         )
-        await db.chat_history.insert_one(chat_message.dict())
+        await db.chat_history.insert_one(chat_message.model_dump())
         
         return {"response": response}
         
@@ -357,8 +506,9 @@ Recent Network Metrics:
 
 @api_router.get("/chat/history", response_model=List[ChatMessage])
 async def get_chat_history():
-    history = await db.chat_history.find().sort("timestamp", -1).to_list(50)
-    return [ChatMessage(**msg) for msg in history]
+    history = await db.chat_history.find({}, {"_id": 0}).sort("timestamp", -1).to_list(50)
+    # Documents were written from ChatMessage, so skip re-validation
+    return [ChatMessage.model_construct(**msg) for msg in history]
 
 @api_router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -373,18 +523,18 @@ async def websocket_endpoint(websocket: WebSocket):
 
 @api_router.post("/simulation/start")
 async def start_simulation():
-    global is_simulation_running
-    if not is_simulation_running:
-        is_simulation_running = True
+    global sim_stop
+    if sim_stop is None or sim_stop.is_set():
+        sim_stop = asyncio.Event()
         await initialize_network()
-        asyncio.create_task(simulation_loop())
+        asyncio.create_task(simulation_loop(sim_stop))
         return {"message": "Network simulation started"}
     return {"message": "Simulation already running"}
 
 @api_router.post("/simulation/stop")
 async def stop_simulation():
-    global is_simulation_running
-    is_simulation_running = False
+    if sim_stop:
+        sim_stop.set()
     return {"message": "Network simulation stopped"}
 
 # Include router
@@ -409,15 +559,37 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_event():
     """Start the simulation when the app starts"""
-    global is_simulation_running
-    if not is_simulation_running:
-        is_simulation_running = True
+    global sim_stop, alert_writer_task
+    
+    # Earlier restarts could leave several node documents per IP; keep one so
+    # the unique ip_address index can be built
+    async for group in db.network_nodes.aggregate([
+        {"$group": {"_id": "$ip_address", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]):
+        await db.network_nodes.delete_many({"_id": {"$in": group["ids"][1:]}})
+    
+    # Indexes backing the per-tick upserts, alert resolution and /alerts query
+    await db.network_nodes.create_index("id", unique=True)
+    await db.network_nodes.create_index("ip_address", unique=True)
+    await db.network_alerts.create_index("id", unique=True)
+    await db.network_alerts.create_index([("resolved", 1), ("timestamp", -1)])
+    
+    alert_writer_task = asyncio.create_task(alert_writer())
+    
+    if sim_stop is None or sim_stop.is_set():
+        sim_stop = asyncio.Event()
         await initialize_network()
-        asyncio.create_task(simulation_loop())
+        asyncio.create_task(simulation_loop(sim_stop))
         logger.info("Network simulation started automatically")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    global is_simulation_running
-    is_simulation_running = False
+    if sim_stop:
+        sim_stop.set()
+    if alert_writer_task:
+        # Let the writer finish its current batch and drain the queue
+        await alert_queue.put(None)
+        await alert_writer_task
+    await flush_alerts()
     client.close()
\ No newline at end of file
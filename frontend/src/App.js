@@ -63,6 +63,8 @@ ChartJS.register(
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+// Network updates arrive as binary frames of UTF-8 encoded JSON
+const textDecoder = new TextDecoder();
 
 const App = () => {
   const [nodes, setNodes] = useState([]);
@@ -91,6 +93,7 @@ const App = () => {
   const connectWebSocket = () => {
     const wsUrl = BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://');
     wsRef.current = new WebSocket(`${wsUrl}/api/ws`);
+    wsRef.current.binaryType = 'arraybuffer';
     
     wsRef.current.onopen = () => {
       setWsConnected(true);
@@ -99,7 +102,8 @@ const App = () => {
     
     wsRef.current.onmessage = (event) => {
       try {
-        const data = JSON.parse(event.data);
+        const raw = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+        const data = JSON.parse(raw);
         if (data.type === 'network_update') {
           setNodes(data.nodes);
         }